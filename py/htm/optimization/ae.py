@@ -118,8 +118,10 @@ import random
 import time
 import datetime
 import tempfile
+import pickle
 import threading
 from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
 import psutil
 import re
 import numpy as np
@@ -450,8 +452,8 @@ class Laboratory:
                 trial.start()
                 pool.append(trial)
 
-            # Wait for experiments to complete.
-            time.sleep(2)
+            # Wait for any experiment to either exit or send back its score.
+            wait([trial.sentinel for trial in pool] + [trial.output for trial in pool])
 
             # Check for jobs which have finished.
             for idx in range(len(pool)-1, -1, -1):
@@ -523,7 +525,19 @@ class Worker(Process):
 
         run_time = datetime.timedelta(seconds = time.time() - start_time)
         print("Elapsed Time: " + str(run_time))
-        self.input.send( exec_globals['score'] )
+        score = exec_globals['score']
+        try:
+            pickle.loads( pickle.dumps( score ))
+        except Exception:
+            # The score is sent back to the main process through a pipe, which
+            # pickles it.  Some exceptions can not be pickled or unpickled.
+            message = '%s: %s'%(type(score).__name__, str(score))
+            # Keep unacceptable exceptions unacceptable, so the lab still exits.
+            if isinstance(score, tuple(acceptable_exceptions)):
+                score = RuntimeError(message)
+            else:
+                score = Exception(message)
+        self.input.send( score )
 
     def is_alive(self):
         """
@@ -17,6 +17,7 @@
 import pprint
 import hashlib
 import copy
+import numpy as np
 
 # TODO: Consider allowing lists, and converting all lists into tuples.
 
@@ -157,3 +158,26 @@ class ParameterSet(dict):
         else:
             retval.append('')
         return sorted(retval)
+
+    def to_array(self, dtype=np.float64):
+        """
+        Convert parameters into a flat numpy array, of float64 by default.
+        The values are in the same order as the paths returned by enumerate().
+        """
+        if not hasattr(self, '_paths'):
+            self._paths = self.enumerate()
+        return np.array([self.get( path ) for path in self._paths], dtype=dtype)
+
+    def from_array(self, array):
+        """
+        Modifies this set of parameters!
+        Argument array is a flat sequence of numbers, see method to_array().
+        """
+        if not hasattr(self, '_paths'):
+            self._paths = self.enumerate()
+        assert(len(array) == len(self._paths))
+        for path, value in zip(self._paths, array):
+            # Convert through a string so that single precision values keep
+            # their shortest representation, instead of gaining noisy digits.
+            self.apply( path, float(str( value )) )
+        return self
@@ -31,97 +31,156 @@ assert(velocity_strength + particle_strength / 2 + global_strength / 2 >= 1)
 import sys
 import os
 import random
-import pickle
+import io
+import threading
 import numpy as np
 import math
 
+try:
+    # Numba is optional, it compiles the particle velocity update.
+    from numba import njit
+except ImportError:
+    njit = None
+
 from htm.optimization.parameter_set import ParameterSet
 from htm.optimization.optimizers import BaseOptimizer
 
+# Random number generator for the particle updates.
+rng = np.random.default_rng()
+
+# Data type of the particle positions and velocities.  Single precision is
+# plenty for this noisy search.  Scores are still kept as python floats.
+particle_dtype = np.float32
+
+def _step(velocity, position, particle_best, global_best, r1, r2):
+    """ Modifies the velocity and then the position arrays in place. """
+    velocity *= velocity_strength
+    velocity += (particle_best - position) * particle_strength * r1
+    velocity += (global_best   - position) * global_strength   * r2
+    position += velocity
+
+def _step_loop(velocity, position, particle_best, global_best, r1, r2):
+    """ Same as _step, written as a single loop for numba. """
+    for i in range(velocity.size):
+        particle_bias = (particle_best[i] - position[i]) * particle_strength * r1[i]
+        global_bias   = (global_best[i]   - position[i]) * global_strength   * r2[i]
+        velocity[i]   = velocity[i] * velocity_strength + particle_bias + global_bias
+        position[i]  += velocity[i]
+
+if njit is not None:
+    _step = njit(fastmath=True, cache=True)( _step_loop )
+
+def _nan_if_none(value):
+    return float('nan') if value is None else value
+
+def _none_if_nan(value):
+    return None if math.isnan(value) else float(value)
+
 class ParticleData:
     """
     Attributes:
-        p.parameters - ParameterSet
-        p.velocities - ParameterSet full of float
-        p.best       - ParameterSet
-        p.score      - float
+        p.parameters - ParameterSet, only updated when this particle is
+                       suggested for evaluation.
+        p.position   - numpy array of particle_dtype, see ParameterSet.to_array()
+        p.velocity   - numpy array of particle_dtype
+        p.paths      - List of the parameter paths, in the same order as the arrays.
+        p.is_int     - numpy array of bool, which parameters are integers.
+        p.best       - numpy array of particle_dtype
+        p.best_score - float
         p.age        - Number of times this particle has been evaluated/updated.
         p.lock       - Is this particle currently being evaluated?
+
+    The position and velocity arrays are always modified in place, because they
+    can be rows of the swarm's arrays.  See ParticleSwarmOptimization.
     """
     def __init__(self, initial_parameters, swarm=None):
         self.parameters = ParameterSet( initial_parameters )
+        self.paths      = self.parameters.enumerate()
+        self.position   = self.parameters.to_array( particle_dtype )
+        self.is_int     = np.empty(len(self.paths), dtype=bool)
+        for idx, path in enumerate(self.paths):
+            value = self.parameters.get(path)
+            if isinstance(value, float):
+                self.is_int[idx] = False
+            elif isinstance(value, int):
+                self.is_int[idx] = True
+            else:
+                raise NotImplementedError()
         self.best       = None
         self.best_score = None
         self.age        = 0
+        self.velocity   = np.zeros_like( self.position )
         self.initialize_velocities(swarm)
         self.lock       = False
 
     def initialize_velocities(self, swarm=None):
-        # Make a new parameter structure for the velocity data.
-        self.velocities = ParameterSet( self.parameters )
-        # Iterate through every field in the structure.
-        for path in self.parameters.enumerate():
-            value = self.parameters.get(path)
-            if swarm is not None:
-                # Analyse the other particle velocities, so that the new
-                # velocity is not too large or too small.
-                data = [p.velocities.get(path) for p in swarm if p is not self]
-                velocity = np.random.normal(np.mean(data), np.std(data))
-            else:
-                # New swarm, start with a large random velocity.
-                max_percent_change = .10
-                uniform = 2 * random.random() - 1
-                if isinstance(value, float):
-                    velocity = value * uniform * max_percent_change
-                elif isinstance(value, int):
-                    if abs(value) < 1. / max_percent_change:
-                        velocity = uniform # Parameters are rounded, so 50% chance this will mutate.
-                    else:
-                        velocity = value * uniform * max_percent_change
-                else:
-                    raise NotImplementedError()
-            self.velocities.apply( path, velocity )
+        others = [p.velocity for p in swarm if p is not self] if swarm is not None else []
+        if others:
+            # Analyse the other particle velocities, so that the new
+            # velocity is not too large or too small.
+            data = np.array( others )
+            self.velocity[:] = rng.normal(np.mean(data, axis=0), np.std(data, axis=0))
+        else:
+            # New swarm, start with a large random velocity.
+            max_percent_change = particle_dtype(.10)
+            # Parameters are rounded, so 50% chance small integers will mutate.
+            small_int = self.is_int & (np.abs(self.position) < 1. / max_percent_change)
+            uniform   = 2 * rng.random(len(self.position), dtype=particle_dtype) - 1
+            self.velocity[:] = np.where(small_int, uniform,
+                                        self.position * uniform * max_percent_change)
 
     def update_position(self):
-        for path in self.parameters.enumerate():
-            position = self.parameters.get( path )
-            velocity = self.velocities.get( path )
-            self.parameters.apply( path, position + velocity )
-
-    def update_velocity(self, global_best):
-        for path in self.parameters.enumerate():
-            postition     = self.parameters.get( path )
-            velocity      = self.velocities.get( path )
-            particle_best = self.best.get( path ) if self.best is not None else postition
-            global_best_x = global_best.get( path ) if global_best is not None else postition
-
-            # Update velocity.
-            particle_bias = (particle_best - postition) * particle_strength * random.random()
-            global_bias   = (global_best_x - postition)   * global_strength   * random.random()
-            velocity = velocity * velocity_strength + particle_bias + global_bias
-            self.velocities.apply( path, velocity )
+        self.position += self.velocity
+
+    def step(self, global_best):
+        """
+        Update the velocity and then move the particle by its new velocity.
+        Argument global_best is a numpy array, or None.
+        """
+        dims          = len(self.position)
+        particle_best = self.best if self.best is not None else self.position
+        global_best_x = global_best if global_best is not None else self.position
+
+        r1, r2        = rng.random((2, dims), dtype=particle_dtype)
+        _step(self.velocity, self.position, particle_best, global_best_x, r1, r2)
 
     def update(self, score, global_best):
         self.age += 1
         if self.best_score is not None:
             self.best_score *= 1 - score_decay_rate
         if self.best is None or score > self.best_score:
-            self.best       = ParameterSet( self.parameters )
+            self.best       = np.array( self.position )
             self.best_score = score
             print("New particle best score %g."%self.best_score)
-        self.update_position()
-        self.update_velocity( global_best )
+        self.step( global_best )
 
 
 class ParticleSwarmOptimization(BaseOptimizer):
     """
+    This is an asynchronous particle swarm.  Each particle is updated as soon as
+    its own evaluation finishes, using the current global best, and is then free
+    to be suggested again.  There are no rounds, so a slow experiment never
+    holds up the rest of the swarm.
+
     Attributes:
         pso.lab           - Laboratory
         pso.particles     - Number of particles to use.
-        pso.swarm_path    - Data File for this particle swarm.
+        pso.swarm_path    - Data File for this particle swarm, numpy ".npz" format.
+        pso.log_path      - Data File for the updates since the swarm was last saved.
+        pso.log_length    - Number of updates in the log file.
+        pso.save_interval - Number of updates to log before rewriting the swarm file.
+        pso.log           - Open file object of the log file.
+        pso.save_thread   - Thread which is writing the swarm file, or None.
         pso.swarm         - List of ParticleData
+        pso.positions     - numpy array with shape (particles, dims), the
+                            particle positions are the rows of this array.
+        pso.velocities    - numpy array with shape (particles, dims), the
+                            particle velocities are the rows of this array.
         pso.best          - ParameterSet
+        pso.best_position - numpy array, pso.best converted by ParameterSet.to_array()
         pso.best_score    - float
+        pso.evaluating    - Dict of hash(ParameterSet) -> list of indexes into
+                            pso.swarm, for the particles being evaluated.
     """
     def add_arguments(parser):
         parser.add_argument('--swarming', type=int,
@@ -131,20 +190,36 @@ class ParticleSwarmOptimization(BaseOptimizer):
             help=('Remove all scores from the particle swarm so that the '
                   'experiment can be safely altered.'))
 
+        parser.add_argument('--swarm_save_interval', type=int, default=None,
+            help=('Number of evaluations between rewrites of the particle '
+                  'swarm file, defaults to the number of particles.'))
+
     def use_this_optimizer(args):
         return args.swarming or args.clear_scores
 
     def __init__(self, lab, args):
-        self.swarm_path    = os.path.join( lab.ae_directory, 'particle_swarm.pickle' )
+        self.lab           = lab
+        self.swarm_path    = os.path.join( lab.ae_directory, 'particle_swarm.npz' )
+        self.log_path      = os.path.join( lab.ae_directory, 'particle_swarm.log' )
+        # Swarms used to be pickled, and those files can not be loaded anymore.
+        old_swarm_path     = os.path.join( lab.ae_directory, 'particle_swarm.pickle' )
+        if os.path.exists(old_swarm_path) and not os.path.exists(self.swarm_path):
+            raise SystemExit(("Found particle swarm in an old format: %s\n"
+                "It can not be loaded, delete it and its \".log\" file to start a new swarm.")
+                %old_swarm_path)
+        self.log           = None
+        self.save_thread   = None
         if args.clear_scores:
             self.clear_scores()
             sys.exit()
         # Setup the particle swarm.
-        self.lab           = lab
         self.swarm         = []
         self.particles     = args.swarming
+        self.save_interval = args.swarm_save_interval or self.particles
         self.best          = None
+        self.best_position = None
         self.best_score    = None
+        self.evaluating    = {}
         assert( self.particles >= args.processes )
         # Try loading an existing particle swarm.
         try:
@@ -164,38 +239,51 @@ class ParticleSwarmOptimization(BaseOptimizer):
             if( len(self.swarm) >= 3 ):
                 new_particle.update_position()
             self.swarm.append( new_particle )
+        self.pack_swarm()
         # Clear all of the mutex locks before starting.
         for particle in self.swarm:
             particle.lock = False
+        # Start with a fresh copy of the swarm on file, and an empty log.
+        self.save()
 
     def suggest_parameters(self):
-        unlocked_particles = [p for p in self.swarm if not p.lock]
+        unlocked_particles = [idx for idx, p in enumerate(self.swarm) if not p.lock]
         if not unlocked_particles:
-            print("Thread blocked waiting for particle to evaluate.")
-            time.sleep( 60 )
-            return self.suggest_parameters()
+            # Each running experiment locks one particle, and there are at least
+            # as many particles as processes.  So this should never happen.
+            raise RuntimeError("All particles are being evaluated!")
 
-        particle_data = random.choice( unlocked_particles )
+        index         = random.choice( unlocked_particles )
+        particle_data = self.swarm[ index ]
+        particle_data.parameters.from_array( particle_data.position )
         particle_data.parameters.typecast( self.lab.structure )
+        # Keep the particle at the position which is actually evaluated.
+        particle_data.position[:] = particle_data.parameters.to_array( particle_dtype )
         particle_data.lock = True
-        return particle_data.parameters
+        self.evaluating.setdefault(hash(particle_data.parameters), []).append( index )
+        # Return a copy because the particle reuses its ParameterSet the next
+        # time it is suggested.
+        return ParameterSet( particle_data.parameters )
 
     def collect_results(self, parameters, score):
-        # Get the particle for these parameters.
-        for particle in self.swarm:
-            if particle.parameters == parameters:
-                break
-        else:
+        # Get the particle for these parameters.  Several particles can be
+        # evaluating the same parameters, any one of them can take this result.
+        indexes = self.evaluating.get(hash(parameters))
+        if not indexes:
             raise Exception("Unrecognized parameters!")
+        index    = indexes.pop(0)
+        particle = self.swarm[ index ]
+        if not indexes:
+            del self.evaluating[hash(parameters)]
 
         if isinstance(score, Exception) or math.isnan(score):
             # Program crashed, replace this particle.
             if particle.best is not None:
-                particle.parameters = ParameterSet( particle.best )
+                particle.position[:] = particle.best
             elif self.best is not None:
-                particle.parameters = ParameterSet( self.best )
+                particle.position[:] = self.best_position
             else:
-                particle.parameters = ParameterSet( self.lab.default_parameters)
+                particle.position[:] = self.lab.default_parameters.to_array( particle_dtype )
             particle.initialize_velocities( self.swarm )
             particle.update_position()
         else:
@@ -203,25 +291,164 @@ class ParticleSwarmOptimization(BaseOptimizer):
             if self.best_score is not None:
                 self.best_score *= 1 - score_decay_rate / len(self.swarm)
             if self.best is None or score > self.best_score:
-                self.best       = ParameterSet( particle.parameters )
-                self.best_score = score
+                self.best          = ParameterSet( particle.parameters )
+                self.best_position = self.best.to_array( particle_dtype )
+                self.best_score    = score
                 print("New global best score %g."%score)
                 print(self.best) 
-            particle.update( score, self.best )
+            particle.update( score, self.best_position )
         particle.lock = False
-        self.save()
+        self.save_update( index )
+
+    def save(self, background=False):
+        """
+        Write the whole swarm to file, and start a new empty log of updates.
+
+        If background is True then the swarm file is written by a separate
+        thread, so that the experiments are not held up waiting on the disk.
+        The old log is kept until the new swarm file is in place.
+
+        Only one AE process may use a particle swarm at a time.
+        """
+        self.wait_for_save()
+        dims  = len(self.lab.default_parameters.enumerate())
+        empty = np.full(dims, np.nan, dtype=particle_dtype)
+        data  = io.BytesIO()
+        np.savez(data,
+            paths         = self.lab.default_parameters.enumerate(),
+            position      = self.positions,
+            velocity      = self.velocities,
+            best          = [p.best if p.best is not None else empty for p in self.swarm],
+            best_score    = [_nan_if_none(p.best_score) for p in self.swarm],
+            age           = [p.age for p in self.swarm],
+            global_best   = self.best_position if self.best is not None else empty,
+            global_score  = _nan_if_none(self.best_score),)
+        data    = data.getvalue()
+        old_log = self.log_path + '.old'
+        if self.log is not None:
+            self.log.close()
+        # An old log left over from an interrupted save has already been loaded,
+        # so write this swarm file in the foreground to replace it.
+        if background and not os.path.exists(old_log):
+            if os.path.exists(self.log_path):
+                os.replace(self.log_path, old_log)
+            self.save_thread = threading.Thread(target=self.write_swarm, args=(data,))
+            self.save_thread.start()
+        else:
+            self.write_swarm(data)
+        self.log        = open(self.log_path, 'wb')
+        self.log_length = 0
+
+    def write_swarm(self, data):
+        """
+        Argument data is the contents of the swarm file.
+
+        The data is written to a temporary file which then replaces the swarm
+        file, so the swarm file is never left half written.
+        """
+        with open(self.swarm_path + '.tmp', 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.swarm_path + '.tmp', self.swarm_path)
+        if os.path.exists(self.log_path + '.old'):
+            os.remove(self.log_path + '.old')
+
+    def wait_for_save(self):
+        """ Block until the swarm file is done being written to. """
+        if self.save_thread is not None:
+            self.save_thread.join()
+            self.save_thread = None
+
+    def save_update(self, index):
+        """
+        Append the particle at the given index to the log of updates.  The log
+        is merged into the main swarm file once every particle has had a chance
+        to be updated.
 
-    def save(self):
-        data = (self.swarm, self.best, self.best_score)
-        with open(self.swarm_path, 'wb') as file:
-            pickle.dump(data, file)
+        Each update is a single numpy array of float64, containing:
+            index, age, best score, global best score, position, velocity,
+            best position, global best position.
+        """
+        particle = self.swarm[index]
+        dims     = len(particle.position)
+        empty    = np.full(dims, np.nan)
+        record   = np.concatenate([
+            [index, particle.age, _nan_if_none(particle.best_score), _nan_if_none(self.best_score)],
+            particle.position,
+            particle.velocity,
+            particle.best if particle.best is not None else empty,
+            self.best_position if self.best is not None else empty,])
+        np.save(self.log, record)
+        self.log.flush()
+        self.log_length += 1
+        if self.log_length >= max(1, self.save_interval):
+            self.save( background=True )
 
     def load(self):
-        with open(self.swarm_path, 'rb') as file:
-            data = pickle.load( file )
-        self.swarm, self.best, self.best_score = data
+        with np.load(self.swarm_path) as file:
+            data = {name: file[name] for name in file.files}
+        if list(data['paths']) != self.lab.default_parameters.enumerate():
+            raise ValueError("Particle swarm on file does not match the structure of the default parameters!")
+        self.swarm = []
+        for idx in range(len(data['age'])):
+            particle = ParticleData( self.lab.default_parameters )
+            self.swarm.append( particle )
+            self.set_particle( idx, data['age'][idx], data['best_score'][idx],
+                data['position'][idx], data['velocity'][idx], data['best'][idx])
+        self.pack_swarm()
+        self.set_global_best( data['global_score'], data['global_best'] )
+        # Replay the updates which were made after the swarm was last saved.
+        self.log_length = 0
+        for path in (self.log_path + '.old', self.log_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb', buffering=2**20) as file:
+                while True:
+                    try:
+                        record = np.load( file )
+                    except (EOFError, ValueError):
+                        # np.load raises these at the end of the file.  The last
+                        # update might be incomplete.
+                        break
+                    index, age, best_score, global_score = record[:4]
+                    position, velocity, best, global_best = np.split(record[4:], 4)
+                    self.set_particle( int(index), age, best_score, position, velocity, best )
+                    self.set_global_best( global_score, global_best )
+                    self.log_length += 1
         print( self.summary() )
 
+    def pack_swarm(self):
+        """
+        Move the positions and velocities of all particles into two contiguous
+        arrays, which the particles then refer to by row.
+        """
+        self.positions  = np.array([p.position for p in self.swarm], dtype=particle_dtype)
+        self.velocities = np.array([p.velocity for p in self.swarm], dtype=particle_dtype)
+        for particle, position, velocity in zip(self.swarm, self.positions, self.velocities):
+            particle.position = position
+            particle.velocity = velocity
+
+    def set_particle(self, index, age, best_score, position, velocity, best):
+        """ Restore a particle from file.  Missing values are stored as NaN. """
+        particle             = self.swarm[index]
+        particle.age         = int(age)
+        particle.best_score  = _none_if_nan( best_score )
+        particle.position[:] = position
+        particle.velocity[:] = velocity
+        particle.best        = None if np.isnan(best).all() else np.array( best, dtype=particle_dtype )
+
+    def set_global_best(self, score, position):
+        """ Restore the global best from file.  Missing values are stored as NaN. """
+        self.best_score = _none_if_nan( score )
+        if np.isnan(position).all():
+            self.best          = None
+            self.best_position = None
+        else:
+            self.best_position = np.array( position, dtype=particle_dtype )
+            self.best          = ParameterSet( self.lab.default_parameters )
+            self.best.from_array( self.best_position ).typecast( self.lab.structure )
+
     def clear_scores(self):
         try:
             self.load()
@@ -244,19 +471,16 @@ class ParticleSwarmOptimization(BaseOptimizer):
         best = [p.best_score for p in swarm if p.best_score is not None]
         s += ("Best score Min/Mean/Std/Max %g / %g / %g / %g\n"%
                             (min(best), np.mean(best), np.std(best), max(best)))
-        str_len = max( len(p) for p in swarm[0].parameters.enumerate() )
+        paths     = swarm[0].paths
+        str_len   = max( len(p) for p in paths )
+        positions = np.array([p.position for p in swarm])
         s += "\nParameters, Min/Mean/Std/Max:\n"
-        for path in swarm[0].parameters.enumerate():
-            data = []
-            for p in swarm:
-                data.append( p.parameters.get( path ) )
+        for path, data in zip(paths, positions.T):
             s += path.ljust(str_len) + "\t%g / %g / %g / %g\n"%( # TODO: Center these data fields...
                                 min(data), np.mean(data), np.std(data), max(data))
+        velocities = np.array([p.velocity for p in swarm])
         s += "\nVelocities, Min/Mean/Std/Max:\n"
-        for path in swarm[0].parameters.enumerate():
-            data = []
-            for p in swarm:
-                data.append( p.velocities.get( path ) )
+        for path, data in zip(paths, velocities.T):
             s += path.ljust(str_len) + "\t%g / %g / %g / %g\n"%( # TODO: Center these data fields...
                                 min(data), np.mean(data), np.std(data), max(data))
 
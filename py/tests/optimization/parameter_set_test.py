@@ -0,0 +1,57 @@
+# ------------------------------------------------------------------------------
+# HTM Community Edition of NuPIC
+# Copyright (C) 2019, David McDougall
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero Public License version 3 as published by the Free
+# Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero Public License for more details.
+#
+# You should have received a copy of the GNU Affero Public License along with
+# this program.  If not, see http://www.gnu.org/licenses.
+# ------------------------------------------------------------------------------
+
+"""Unit tests for htm.optimization.parameter_set"""
+
+import numpy as np
+import unittest
+
+from htm.optimization.parameter_set import ParameterSet
+
+
+class ParameterSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parameters = ParameterSet({'a': 1.5, 'b': (3, 40), 'c': {'x': 0.01, 'y': 200}})
+
+    def testToArray(self):
+        array = self.parameters.to_array()
+        self.assertEqual(array.dtype, np.float64)
+        self.assertEqual(list(array), [1.5, 3, 40, 0.01, 200])
+        self.assertEqual(self.parameters.to_array(np.float32).dtype, np.float32)
+
+    def testFromArray(self):
+        p = ParameterSet( self.parameters )
+        p.from_array([2.5, 4, 41, 0.02, 201])
+        self.assertEqual(p.get("['a']"),      2.5)
+        self.assertEqual(p.get("['b'][1]"),   41)
+        self.assertEqual(p.get("['c']['x']"), 0.02)
+
+    def testRoundTrip(self):
+        p = ParameterSet( self.parameters )
+        p.from_array( self.parameters.to_array() ).typecast( self.parameters.get_types() )
+        self.assertEqual(p, self.parameters)
+        self.assertEqual(hash(p), hash(self.parameters))
+
+    def testFromArraySinglePrecision(self):
+        """ Single precision values should not gain noisy digits. """
+        p = ParameterSet( self.parameters )
+        p.from_array( self.parameters.to_array(np.float32) )
+        self.assertEqual(p.get("['c']['x']"), 0.01)
+
+
+if __name__ == "__main__":
+    unittest.main()
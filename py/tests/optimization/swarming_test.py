@@ -0,0 +1,134 @@
+# ------------------------------------------------------------------------------
+# HTM Community Edition of NuPIC
+# Copyright (C) 2019, David McDougall
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero Public License version 3 as published by the Free
+# Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero Public License for more details.
+#
+# You should have received a copy of the GNU Affero Public License along with
+# this program.  If not, see http://www.gnu.org/licenses.
+# ------------------------------------------------------------------------------
+
+"""Unit tests for saving and loading the particle swarm in htm.optimization.swarming"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from htm.optimization.parameter_set import ParameterSet
+from htm.optimization.swarming import ParticleSwarmOptimization
+
+
+class FakeLaboratory:
+    """ Has only the attributes of htm.optimization.ae.Laboratory which swarming uses. """
+    def __init__(self, ae_directory):
+        self.ae_directory       = ae_directory
+        self.default_parameters = ParameterSet({'a': 1.5, 'b': (3, 40), 'c': {'x': 0.01, 'y': 200}})
+        self.structure          = self.default_parameters.get_types()
+
+
+def score(parameters):
+    return -(parameters['a'] - 2) ** 2 - (parameters['b'][0] - 5) ** 2
+
+
+class SwarmingSaveLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lab       = FakeLaboratory(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def createSwarm(self, save_interval=None):
+        args = argparse.Namespace(swarming=5, processes=1, clear_scores=False,
+                                  swarm_save_interval=save_interval)
+        return ParticleSwarmOptimization(self.lab, args)
+
+    def evaluate(self, pso, num_evaluations):
+        for _ in range(num_evaluations):
+            parameters = pso.suggest_parameters()
+            pso.collect_results(parameters, score(parameters))
+
+    def close(self, pso):
+        """ Stop writing to the swarm files, as if the program exited. """
+        pso.wait_for_save()
+        pso.log.close()
+
+    def getState(self, pso):
+        return {
+            'position':   np.array([p.position for p in pso.swarm]),
+            'velocity':   np.array([p.velocity for p in pso.swarm]),
+            'best':       [p.best for p in pso.swarm],
+            'best_score': [p.best_score for p in pso.swarm],
+            'age':        [p.age for p in pso.swarm],
+            'global':     (pso.best, pso.best_score),}
+
+    def assertStateEqual(self, state, pso):
+        other = self.getState(pso)
+        np.testing.assert_array_equal(state['position'], other['position'])
+        np.testing.assert_array_equal(state['velocity'], other['velocity'])
+        for best, other_best in zip(state['best'], other['best']):
+            if best is None:
+                self.assertIsNone(other_best)
+            else:
+                np.testing.assert_array_equal(best, other_best)
+        self.assertEqual(state['best_score'], other['best_score'])
+        self.assertEqual(state['age'],        other['age'])
+        self.assertEqual(state['global'],     other['global'])
+
+    def testSaveLoad(self):
+        pso = self.createSwarm()
+        self.evaluate(pso, 12)
+        pso.save()
+        self.close(pso)
+        state = self.getState(pso)
+        self.assertStateEqual(state, self.createSwarm())
+
+    def testReplayLog(self):
+        pso = self.createSwarm(save_interval=1000)
+        self.evaluate(pso, 12)
+        self.close(pso)
+        self.assertEqual(pso.log_length, 12)
+        self.assertStateEqual(self.getState(pso), self.createSwarm())
+
+    def testTruncatedLog(self):
+        pso = self.createSwarm(save_interval=1000)
+        self.evaluate(pso, 11)
+        state = self.getState(pso)
+        self.evaluate(pso, 1)
+        self.close(pso)
+        # Cut the last update in half.
+        size        = os.path.getsize(pso.log_path)
+        record_size = size // pso.log_length
+        with open(pso.log_path, 'r+b') as file:
+            file.truncate(size - record_size // 2)
+        loaded = self.createSwarm()
+        self.assertEqual(loaded.evaluating, {})
+        self.assertStateEqual(state, loaded)
+
+    def testReplayOldLog(self):
+        """ Interrupted background save: the old log was set aside, but the new
+        swarm file was never written. """
+        pso = self.createSwarm(save_interval=1000)
+        self.evaluate(pso, 7)
+        pso.log.close()
+        os.replace(pso.log_path, pso.log_path + '.old')
+        pso.log = open(pso.log_path, 'wb')
+        self.evaluate(pso, 5)
+        self.close(pso)
+        self.assertStateEqual(self.getState(pso), self.createSwarm())
+        # Loading the swarm writes a new swarm file, which replaces the old log.
+        self.assertFalse(os.path.exists(pso.log_path + '.old'))
+
+
+if __name__ == "__main__":
+    unittest.main()